@@ -1,19 +1,143 @@
 import argparse
+import atexit
+import csv
 import cv2
 import os 
 import json
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from gaze_tracking import GazeTracking
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging. Records are queued and written to stderr by a background
+# listener thread, so the processing loop never blocks on log I/O.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-def process_video(input_path, output_path, json_output_path, csv_output_path):
-    # Initialize GazeTracking
-    gaze = GazeTracking()
+# Cap OpenCV's internal thread pool, the pipeline stages already run in parallel
+cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
 
+QUEUE_SIZE = 8
+
+# MediaPipe graphs are not fork-safe, so the pipeline stages are always started
+# in fresh interpreters
+_MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def _pin_to_cpu(stage):
+    # Pin the calling process to one of the CPUs it is allowed to run on
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    try:
+        os.sched_setaffinity(0, {cpus[stage % len(cpus)]})
+    except OSError:
+        pass
+
+
+def _pin_analysis(nb_io_stages):
+    # Keep the analysis stage, and the TFLite threads MediaPipe starts, off
+    # the CPUs the decode and encode stages were pinned to. Returns the
+    # previous CPU set, to restore once the video is done.
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) <= nb_io_stages:
+        return None
+    try:
+        os.sched_setaffinity(0, set(cpus[nb_io_stages:]))
+    except OSError:
+        return None
+    return set(cpus)
+
+
+def _decode_worker(input_path, frame_queue):
+    _pin_to_cpu(0)
+    video = cv2.VideoCapture(input_path)
+    video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    frame_index = 0
+    while True:
+        # Read a frame from the video
+        ret, frame = video.read()
+
+        # If the frame was not read correctly, stop producing
+        if not ret:
+            break
+
+        frame_queue.put((frame_index, frame))
+        frame_index += 1
+
+    video.release()
+    frame_queue.put(None)
+
+
+# Hardware H.264 encoders, tried in order: desktop NVIDIA (NVENC), then Jetson.
+# nvvidconv doesn't take BGR, the frames are converted to BGRx first.
+GSTREAMER_ENCODERS = (
+    'videoconvert ! nvh264enc',
+    'videoconvert ! video/x-raw,format=BGRx ! nvvidconv ! video/x-raw(memory:NVMM) ! nvv4l2h264enc',
+)
+
+
+def _open_writer(output_path, fps, frame_size):
+    # Prefer a GPU encoder through GStreamer, fall back to software mp4v. The
+    # GStreamer pipelines mux to MP4, so they are only used for .mp4 outputs.
+    encoders = GSTREAMER_ENCODERS if output_path.lower().endswith('.mp4') else ()
+    for encoder in encoders:
+        pipeline = f"appsrc ! {encoder} ! h264parse ! mp4mux ! filesink location=\"{output_path}\""
+        out = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, fps, frame_size)
+        if out.isOpened():
+            logger.info(f"Encoding {output_path} with GStreamer pipeline: {pipeline}")
+            return out
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    return cv2.VideoWriter(output_path, fourcc, fps, frame_size)
+
+
+def _encode_worker(output_path, fps, frame_size, annotated_queue):
+    _pin_to_cpu(1)
+
+    # Create the VideoWriter object
+    out = _open_writer(output_path, fps, frame_size)
+
+    if not out.isOpened():
+        logger.error(f"Error opening video writer: {output_path}")
+
+    # Frames are tagged with their index, write them back in order
+    pending = {}
+    next_index = 0
+    while True:
+        item = annotated_queue.get()
+        if item is None:
+            break
+
+        frame_index, annotated_frame = item
+        pending[frame_index] = annotated_frame
+        while next_index in pending:
+            frame = pending.pop(next_index)
+            if out.isOpened():
+                out.write(frame)
+            next_index += 1
+
+    out.release()
+
+
+def _write_event(events_file, event_count, kind, event_time):
+    # Each event is one element of the JSON array, written right away
+    if event_count:
+        events_file.write(', ')
+    events_file.write(json.dumps([kind, event_time]))
+
+
+def process_video(input_path, output_path, json_output_path, csv_output_path, annotate=True, gaze=None):
     # Load the video file
     video = cv2.VideoCapture(input_path)
 
@@ -27,86 +151,136 @@ def process_video(input_path, output_path, json_output_path, csv_output_path):
     frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = video.get(cv2.CAP_PROP_FPS)
     total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
 
     logger.info(f"Video properties: {frame_width}x{frame_height}, {fps} fps, {total_frames} frames")
 
-    # Define the codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height))
+    # Gaze events are streamed to the JSON file as they are detected, and
+    # saccade frames along with the total frame count to the CSV file
+    events_file = open(json_output_path, 'w')
+    events_file.write('[')
+    saccades_file = open(csv_output_path, 'w', newline='')
+    saccades_writer = csv.writer(saccades_file, lineterminator='\n')
+    saccades_writer.writerow(('saccade_frame', 'total_frames'))
 
-    if not out.isOpened():
-        logger.error(f"Error opening video writer: {output_path}")
-        return
+    # Decode and encode run in their own processes, connected to the gaze
+    # analysis below by bounded queues. Without annotation there is nothing
+    # to encode.
+    frame_queue = _MP_CONTEXT.Queue(maxsize=QUEUE_SIZE)
+    decoder = _MP_CONTEXT.Process(target=_decode_worker, args=(input_path, frame_queue))
 
-    frame_count = 0
-    saccade_count = 0
-    fixation_count = 0
-    gaze_events = []
-    last_event = None
-    saccade_frames = []
+    stages = []
+    annotated_queue = None
+    previous_cpus = None
+    try:
+        decoder.start()
+        stages.append(decoder)
 
-    while True:
-        # Read a frame from the video
-        ret, frame = video.read()
+        if annotate:
+            annotated_queue = _MP_CONTEXT.Queue(maxsize=QUEUE_SIZE)
+            encoder = _MP_CONTEXT.Process(target=_encode_worker,
+                                          args=(output_path, fps, (frame_width, frame_height), annotated_queue))
+            encoder.start()
+            stages.append(encoder)
 
-        # If the frame was not read correctly, break the loop
-        if not ret:
-            break
+        # The children inherited the full CPU set when they started, they pin
+        # themselves to its first CPUs
+        previous_cpus = _pin_analysis(len(stages))
 
-        # Analyze the frame with GazeTracking
-        face_detected = gaze.refresh(frame)
-        annotated_frame = gaze.annotated_frame()
-
-        # Only process gaze events if a face was detected
-        if face_detected:
-            # Detect saccade and fixation
-            is_saccade = gaze.detect_saccade()
-            is_fixation = gaze.detect_fixation()
-
-            # Record events
-            current_time = frame_count / fps
-            current_time = round(current_time, 2)
-
-            if is_saccade and last_event != 'saccade':
-                gaze_events.append(('saccade', current_time))
-                saccade_count += 1
-                last_event = 'saccade'
-                saccade_frames.append(frame_count)
-            elif is_fixation and last_event != 'fixation':
-                gaze_events.append(('fixation', current_time))
-                fixation_count += 1
-                last_event = 'fixation'
-
-            # Add gaze information to the frame
-            left_pupil = gaze.pupil_left_coords()
-            right_pupil = gaze.pupil_right_coords()
-            cv2.putText(annotated_frame, f"Left pupil:  {left_pupil}", (90, 130), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
-            cv2.putText(annotated_frame, f"Right pupil: {right_pupil}", (90, 165), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
-
-        # Write the annotated frame to the output video
-        out.write(annotated_frame)
-
-        # Log progress
-        frame_count += 1
-        if frame_count % 100 == 0:  # Log every 100 frames
-            progress = (frame_count / total_frames) * 100
-            logger.info(f"Processed {frame_count}/{total_frames} frames ({progress:.2f}%)")
-
-    # Release resources
-    video.release()
-    out.release()
+        # Initialize GazeTracking in the analysis stage only. A given instance is
+        # reused, its MediaPipe graph is only loaded once. It is imported here
+        # rather than at the top, so the decode and encode processes, which
+        # re-run this module when they spawn, don't load MediaPipe.
+        if gaze is None:
+            from gaze_tracking import GazeTracking
+            gaze = GazeTracking()
+        else:
+            gaze.reset()
+
+        frame_count = 0
+        saccade_count = 0
+        fixation_count = 0
+        last_event = None
+
+        while True:
+            item = frame_queue.get()
 
-    # Write gaze events to JSON file
-    with open(json_output_path, 'w') as f:
-        json.dump(gaze_events, f)
+            # The decoder ran out of frames
+            if item is None:
+                break
 
-    # Write saccade frames and total frames to CSV file
-    with open(csv_output_path, 'w') as f:
-        f.write("saccade_frame,total_frames\n")
-        for frame in saccade_frames:
-            f.write(f"{frame},{total_frames}\n")
+            frame_index, frame = item
 
-    logger.info(f"Video processing completed. Output saved to {output_path}")
+            # Analyze the frame with GazeTracking
+            face_detected = gaze.refresh(frame)
+            if annotate:
+                annotated_frame = gaze.annotated_frame()
+
+            # Only process gaze events if a face was detected
+            if face_detected:
+                # Detect saccade and fixation
+                is_saccade = gaze.detect_saccade()
+                is_fixation = gaze.detect_fixation()
+
+                # Record events
+                current_time = frame_index / fps
+                current_time = round(current_time, 2)
+
+                if is_saccade and last_event != 'saccade':
+                    _write_event(events_file, saccade_count + fixation_count, 'saccade', current_time)
+                    saccade_count += 1
+                    last_event = 'saccade'
+                    saccades_writer.writerow((frame_index, total_frames))
+                elif is_fixation and last_event != 'fixation':
+                    _write_event(events_file, saccade_count + fixation_count, 'fixation', current_time)
+                    fixation_count += 1
+                    last_event = 'fixation'
+
+                # Add gaze information to the frame
+                if annotate:
+                    left_pupil = gaze.pupil_left_coords()
+                    right_pupil = gaze.pupil_right_coords()
+                    cv2.putText(annotated_frame, f"Left pupil:  {left_pupil}", (90, 130), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
+                    cv2.putText(annotated_frame, f"Right pupil: {right_pupil}", (90, 165), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
+
+            # Hand the annotated frame over to the encoder
+            if annotate:
+                annotated_queue.put((frame_index, annotated_frame))
+
+            # Log progress
+            frame_count += 1
+            if frame_count % 100 == 0:  # Log every 100 frames
+                progress = (frame_count / total_frames) * 100
+                logger.info(f"Processed {frame_count}/{total_frames} frames ({progress:.2f}%)")
+
+        # Let the encoder write its last frames
+        if annotate:
+            annotated_queue.put(None)
+    except BaseException:
+        # Don't leave the stages blocked on their queues, nothing reads from
+        # or writes to them anymore
+        for stage in stages:
+            stage.terminate()
+        if annotated_queue is not None:
+            annotated_queue.cancel_join_thread()
+        raise
+    finally:
+        # Release resources
+        if previous_cpus is not None:
+            os.sched_setaffinity(0, previous_cpus)
+        for stage in stages:
+            stage.join()
+
+        # Close the JSON array of gaze events, even if the analysis failed,
+        # and the output files
+        events_file.write(']')
+        events_file.close()
+        saccades_file.close()
+
+    if annotate:
+        logger.info(f"Video processing completed. Output saved to {output_path}")
+    else:
+        logger.info("Video processing completed. No output video was written")
     logger.info(f"Gaze events saved to {json_output_path}")
     logger.info(f"Saccade frames saved to {csv_output_path}")
     logger.info(f"Total saccades: {saccade_count}")
@@ -116,37 +290,73 @@ def create_dir_if_not_exist(file_path):
     if not os.path.exists(file_path):
         os.makedirs(file_path)
         
+def _init_pool_worker(worker_counter, nb_workers):
+    # Give each pool worker its own slice of CPUs, which the decode and
+    # encode processes it starts will inherit
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    share = max(1, len(cpus) // nb_workers)
+    worker_cpus = cpus[worker_index * share:(worker_index + 1) * share] or cpus
+    try:
+        os.sched_setaffinity(0, set(worker_cpus))
+    except OSError:
+        pass
+
+
+def _video_job(vid_path, args):
+    file_name = os.path.basename(vid_path)
+    output_path = os.path.join(args.output_vid_dir, file_name)
+    json_output_name = os.path.splitext(file_name)[0] + '.json'
+    json_output_path = os.path.join(args.output_ann_dir, json_output_name)
+    csv_output_name = os.path.splitext(file_name)[0] + '.csv'
+    csv_output_path = os.path.join(args.output_csv_dir, csv_output_name)
+    return (vid_path, output_path, json_output_path, csv_output_path, not args.no_video)
+
+
 def main(args):
-    create_dir_if_not_exist(args.output_vid_dir)
+    if not args.no_video:
+        create_dir_if_not_exist(args.output_vid_dir)
     create_dir_if_not_exist(args.output_ann_dir)
     create_dir_if_not_exist(args.output_csv_dir)
 
     # Process a list of videos
     if os.path.isdir(args.data_path):
-        create_dir_if_not_exist(args.data_path)   
-        for file_name in os.listdir(args.data_path):
-            if file_name.lower().endswith(('.mp4', '.avi', '.mov')):  # Add more video formats if needed
-                vid_path = os.path.join(args.data_path, file_name)
-                output_path = os.path.join(args.output_vid_dir, file_name)
-                json_output_name = os.path.splitext(file_name)[0] + '.json'
-                json_output_path = os.path.join(args.output_ann_dir, json_output_name)
-                csv_output_name = os.path.splitext(file_name)[0] + '.csv'
-                csv_output_path = os.path.join(args.output_csv_dir, csv_output_name)
+        jobs = [_video_job(os.path.join(args.data_path, file_name), args)
+                for file_name in sorted(os.listdir(args.data_path))
+                if file_name.lower().endswith(('.mp4', '.avi', '.mov'))]  # Add more video formats if needed
+
+        # Videos are independent, each worker handles one at a time
+        nb_workers = max(1, min(args.workers, len(jobs)))
+        worker_counter = _MP_CONTEXT.Value('i', 0)
+        with ProcessPoolExecutor(max_workers=nb_workers, mp_context=_MP_CONTEXT,
+                                 initializer=_init_pool_worker,
+                                 initargs=(worker_counter, nb_workers)) as executor:
+            futures = {}
+            for job in jobs:
+                file_name = os.path.basename(job[0])
                 logger.info(f"Starting video processing for {file_name}")
-                process_video(vid_path, output_path, json_output_path, csv_output_path)
-                logger.info(f"Video processing for {file_name} finished")
+                futures[executor.submit(process_video, *job)] = file_name
+
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Video processing for {file_name} failed")
+                else:
+                    logger.info(f"Video processing for {file_name} finished")
 
     # Process a single video file
     elif os.path.isfile(args.data_path):
+        job = _video_job(args.data_path, args)
         file_name = os.path.basename(args.data_path)
-        vid_path = args.data_path
-        output_path = os.path.join(args.output_vid_dir, file_name)
-        json_output_name = os.path.splitext(file_name)[0] + '.json'
-        json_output_path = os.path.join(args.output_ann_dir, json_output_name)
-        csv_output_name = os.path.splitext(file_name)[0] + '.csv'
-        csv_output_path = os.path.join(args.output_csv_dir, csv_output_name)
         logger.info(f"Starting video processing for {file_name}")
-        process_video(vid_path, output_path, json_output_path, csv_output_path)
+        process_video(*job)
         logger.info(f"Video processing for {file_name} finished")
 
     else:
@@ -162,6 +372,10 @@ if __name__ == "__main__":
                         help='Directory for output annotation JSON files')
     parser.add_argument('output_csv_dir', type=str,
                         help='Directory for output CSV files')
+    parser.add_argument('--no-video', action='store_true',
+                        help='Only extract gaze events, skip writing annotated videos')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='Number of videos processed in parallel (default: half the CPU count)')
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -3,6 +3,37 @@ import numpy as np
 import cv2
 from .pupil import Pupil
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+@njit(cache=True)
+def _middle_point(x1, y1, x2, y2):
+    """Returns the middle point (x,y) between two points"""
+    return (x1 + x2) / 2, (y1 + y2) / 2
+
+@njit(cache=True)
+def _blinking_ratio_kernel(left_x, left_y, right_x, right_y,
+                           top1_x, top1_y, top2_x, top2_y,
+                           bottom1_x, bottom1_y, bottom2_x, bottom2_y):
+    """Returns the width of the eye divided by its height, NaN if the
+    eye has no height
+    """
+    top_x, top_y = _middle_point(top1_x, top1_y, top2_x, top2_y)
+    bottom_x, bottom_y = _middle_point(bottom1_x, bottom1_y, bottom2_x, bottom2_y)
+
+    eye_width = math.hypot(left_x - right_x, left_y - right_y)
+    eye_height = math.hypot(top_x - bottom_x, top_y - bottom_y)
+
+    if eye_height == 0.0:
+        return math.nan
+    return eye_width / eye_height
+
 class Eye(object):
     """
     This class creates a new frame to isolate the eye and
@@ -22,76 +53,60 @@ class Eye(object):
 
         self._analyze(frame, landmarks, side, calibration)
 
-    @staticmethod
-    def _middle_point(p1, p2):
-        """Returns the middle point (x,y) between two points
-
-        Arguments:
-            p1 (tuple): First point (x, y)
-            p2 (tuple): Second point (x, y)
-        """
-        x = int((p1[0] + p2[0]) / 2)
-        y = int((p1[1] + p2[1]) / 2)
-        return (x, y)
-
-    def _isolate(self, frame, landmarks, points):
+    def _isolate(self, frame, coords):
         """Isolate an eye, to have a frame without other part of the face.
 
         Arguments:
             frame (numpy.ndarray): Frame containing the face
-            landmarks (list): Facial landmarks from MediaPipe
-            points (list): Points of an eye (from the MediaPipe landmarks)
+            coords (list): Pixel (x,y) of the eye points
         """
-        region = np.array([(int(landmarks[point].x * frame.shape[1]), 
-                            int(landmarks[point].y * frame.shape[0])) for point in points])
-        region = region.astype(np.int32)
+        region = np.array(coords).astype(np.int32)
         self.landmark_points = region
 
-        # Applying a mask to get only the eye
-        height, width = frame.shape[:2]
-        black_frame = np.zeros((height, width), np.uint8)
-        mask = np.full((height, width), 255, np.uint8)
-        cv2.fillPoly(mask, [region], (0, 0, 0))
-        eye = cv2.bitwise_not(black_frame, frame.copy(), mask=mask)
-
-        # Cropping on the eye
+        # Cropping on the eye first, so the masking below only touches
+        # the eye area instead of the whole frame
         margin = 5
-        min_x = np.min(region[:, 0]) - margin
-        max_x = np.max(region[:, 0]) + margin
-        min_y = np.min(region[:, 1]) - margin
-        max_y = np.max(region[:, 1]) + margin
+        min_x = max(int(region[:, 0].min()) - margin, 0)
+        max_x = int(region[:, 0].max()) + margin
+        min_y = max(int(region[:, 1].min()) - margin, 0)
+        max_y = int(region[:, 1].max()) + margin
 
-        self.frame = eye[min_y:max_y, min_x:max_x]
+        eye = frame[min_y:max_y, min_x:max_x]
         self.origin = (min_x, min_y)
 
+        if eye.size == 0:
+            self.frame = eye
+            return
+
+        if eye.ndim == 3:
+            eye = cv2.cvtColor(eye, cv2.COLOR_BGR2GRAY)
+
+        # Applying a mask to get only the eye, everything around it turns white
+        mask = np.full(eye.shape[:2], 255, np.uint8)
+        cv2.fillPoly(mask, [(region - (min_x, min_y)).astype(np.int32)], 0)
+        self.frame = cv2.bitwise_or(eye, mask)
+
         if self.frame is not None and self.frame.size > 0:
             height, width = self.frame.shape[:2]
             self.center = (width / 2, height / 2)
 
-    def _blinking_ratio(self, landmarks, points):
+    def _blinking_ratio(self, coords):
         """Calculates a ratio that can indicate whether an eye is closed or not.
         It's the division of the width of the eye, by its height.
 
         Arguments:
-            landmarks (list): Facial landmarks from MediaPipe
-            points (list): Points of an eye (from the MediaPipe landmarks)
+            coords (list): Pixel (x,y) of the eye points
 
         Returns:
             The computed ratio
         """
-        left = (landmarks[points[0]].x, landmarks[points[0]].y)
-        right = (landmarks[points[3]].x, landmarks[points[3]].y)
-        top = self._middle_point((landmarks[points[1]].x, landmarks[points[1]].y),
-                                 (landmarks[points[2]].x, landmarks[points[2]].y))
-        bottom = self._middle_point((landmarks[points[4]].x, landmarks[points[4]].y),
-                                    (landmarks[points[5]].x, landmarks[points[5]].y))
-
-        eye_width = math.hypot((left[0] - right[0]), (left[1] - right[1]))
-        eye_height = math.hypot((top[0] - bottom[0]), (top[1] - bottom[1]))
-
-        try:
-            ratio = eye_width / eye_height
-        except ZeroDivisionError:
+        (left_x, left_y), (top1_x, top1_y), (top2_x, top2_y), \
+            (right_x, right_y), (bottom1_x, bottom1_y), (bottom2_x, bottom2_y) = coords
+        ratio = _blinking_ratio_kernel(left_x, left_y, right_x, right_y,
+                                       top1_x, top1_y, top2_x, top2_y,
+                                       bottom1_x, bottom1_y, bottom2_x, bottom2_y)
+
+        if math.isnan(ratio):
             ratio = None
 
         return ratio
@@ -113,8 +128,15 @@ class Eye(object):
         else:
             return
 
-        self.blinking = self._blinking_ratio(landmarks, points)
-        self._isolate(frame, landmarks, points)
+        # The landmark fields are read once, both steps below share them. They
+        # are scaled to pixels so the blinking ratio doesn't depend on the
+        # aspect ratio of the frame. A plain list, indexing an array costs
+        # more than the blinking ratio itself.
+        height, width = frame.shape[:2]
+        coords = [(landmarks[point].x * width, landmarks[point].y * height) for point in points]
+
+        self.blinking = self._blinking_ratio(coords)
+        self._isolate(frame, coords)
 
         if self.frame is not None and self.frame.size > 0:
             if not calibration.is_complete():
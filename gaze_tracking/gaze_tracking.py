@@ -1,11 +1,31 @@
 from __future__ import division
+import functools
 import cv2
 import numpy as np
-from collections import deque
 import mediapipe as mp
 from .eye import Eye
 from .calibration import Calibration
 
+def _cuda_enabled():
+    """Returns true if OpenCV was built with CUDA and sees a device"""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+CUDA_ENABLED = _cuda_enabled()
+
+def _per_frame(method):
+    """Caches the result of a method until the next frame is refreshed"""
+    @functools.wraps(method)
+    def wrapper(self):
+        try:
+            return self._frame_cache[method.__name__]
+        except KeyError:
+            result = self._frame_cache[method.__name__] = method(self)
+            return result
+    return wrapper
+
 class GazeTracking(object):
     """
     This class tracks the user's gaze.
@@ -13,45 +33,167 @@ class GazeTracking(object):
     and pupils and allows to know if the eyes are open or closed
     """
 
+    # FaceMesh graphs shared by all the instances of the process, keyed on
+    # their configuration
+    _face_meshes = {}
+
     def __init__(self):
-        self.frame = None
-        self.eye_left = None    
-        self.eye_right = None
-        self.calibration = Calibration()
+        # RGB copy of the frame handed to MediaPipe, reused between frames
+        self._rgb_buf = None
+        # Device buffers of the CUDA path: the uploaded frame, then the
+        # resized and RGB frames, reallocated when the frame size changes
+        self._gpu_frame = cv2.cuda_GpuMat() if CUDA_ENABLED else None
+        self._gpu_resized = None
+        self._gpu_rgb = None
+        self.inference_size = 640  # Longest side of the frame given to MediaPipe
 
-        # Initialize MediaPipe Face Mesh
-        self.mp_face_mesh = mp.solutions.face_mesh
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
+        # MediaPipe Face Mesh, loaded once per process. It only runs its face
+        # detector when tracking from the previous frame's landmarks falls
+        # below min_tracking_confidence, which is kept at MediaPipe's default
+        # so short dips don't trigger a full detection.
+        self.face_mesh = self._get_face_mesh(
             max_num_faces=1,
             refine_landmarks=True,
             min_detection_confidence=0.8,
-            min_tracking_confidence=0.8)
+            min_tracking_confidence=0.5)
+
+        # Last 30 gaze points, stored as one row per coordinate (x, then y).
+        # Each point is written twice, so the most recent points are always a
+        # contiguous slice of columns ending at `_gaze_index + _gaze_capacity`
+        self._gaze_capacity = 30
+        self._gaze = np.zeros((2, 2 * self._gaze_capacity), np.float32)
 
-        self.gaze_points = deque(maxlen=30)  # Store last 30 gaze points
         self.fixation_threshold = 0.05  # Threshold for fixation detection
         self.saccade_threshold = 0.05  # Threshold for saccade detection
         self.min_fixation_duration = 10  # Minimum number of frames for a fixation
 
+        self.reset()
+
+    @classmethod
+    def _get_face_mesh(cls, max_num_faces, refine_landmarks, min_detection_confidence, min_tracking_confidence):
+        """Returns a FaceMesh for the given configuration, loading its graph
+        only the first time it is requested in this process
+        """
+        key = (max_num_faces, refine_landmarks, min_detection_confidence, min_tracking_confidence)
+        if key not in cls._face_meshes:
+            cls._face_meshes[key] = mp.solutions.face_mesh.FaceMesh(
+                max_num_faces=max_num_faces,
+                refine_landmarks=refine_landmarks,
+                min_detection_confidence=min_detection_confidence,
+                min_tracking_confidence=min_tracking_confidence)
+        return cls._face_meshes[key]
+
+    def reset(self, keep_calibration=False):
+        """Forgets everything learned from previous frames (calibration,
+        face tracking, gaze history), so the instance can be reused for a
+        new video
+
+        Arguments:
+            keep_calibration (bool): Keeps the binarization thresholds, for
+                frames that come from the same video
+        """
+        self.frame = None
+        self.eye_left = None
+        self.eye_right = None
+        if not keep_calibration:
+            self.calibration = Calibration()
+        self._frame_cache = {}
+
+        # The FaceMesh is shared by the process, its tracking must not carry
+        # over the face of a frame that doesn't precede the next one
+        self.face_mesh.reset()
+
+        # Per-frame results, computed once in _analyze
+        self._locate_pupils()
+
+        self._gaze_index = 0
+        self._gaze_count = 0
+
+    @property
+    def gaze_points(self):
+        """Returns the recorded gaze points, oldest first, as an (n, 2) array"""
+        return self._recent(self._gaze_count).T.copy()
+
     @property
     def pupils_located(self):
         """Check that the pupils have been located"""
-        try:
-            int(self.eye_left.pupil.x)
-            int(self.eye_left.pupil.y)
-            int(self.eye_right.pupil.x)
-            int(self.eye_right.pupil.y)
-            return True
-        except Exception:
-            return False
+        return self._pupils_ok
+
+    def _locate_pupils(self):
+        """Computes the pupil coordinates and the gaze ratios of the
+        current frame, so the accessors don't have to
+        """
+        self._pupils_ok = False
+        self._h_ratio = None
+        self._v_ratio = None
+        self._left_xy = None
+        self._right_xy = None
+        self._blink_ratio = None
+
+        left = self.eye_left
+        right = self.eye_right
+        if left is None or right is None or left.pupil is None or right.pupil is None:
+            return
+        if left.pupil.x is None or left.pupil.y is None or right.pupil.x is None or right.pupil.y is None:
+            return
+
+        self._pupils_ok = True
+        self._left_xy = (left.origin[0] + left.pupil.x, left.origin[1] + left.pupil.y)
+        self._right_xy = (right.origin[0] + right.pupil.x, right.origin[1] + right.pupil.y)
+        self._h_ratio, self._v_ratio = self._gaze_xy()
+        if left.blinking is not None and right.blinking is not None:
+            self._blink_ratio = (left.blinking + right.blinking) / 2
+
+    def _gaze_xy(self):
+        """Returns the horizontal and vertical gaze ratios, computed in a
+        single pass over both pupils
+        """
+        left_pupil, left_center = self.eye_left.pupil, self.eye_left.center
+        right_pupil, right_center = self.eye_right.pupil, self.eye_right.center
+        return ((left_pupil.x / (left_center[0] * 2 - 10) + right_pupil.x / (right_center[0] * 2 - 10)) * 0.5,
+                (left_pupil.y / (left_center[1] * 2 - 10) + right_pupil.y / (right_center[1] * 2 - 10)) * 0.5)
+
+    def _inference_frame(self):
+        """Returns the RGB frame given to MediaPipe. Landmarks are normalized,
+        so it can be downscaled while the eyes are still isolated on the
+        full resolution frame.
+        """
+        height, width = self.frame.shape[:2]
+        scale = min(1.0, self.inference_size / max(height, width))
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        shape = (size[1], size[0]) + self.frame.shape[2:]
+
+        if self._rgb_buf is None or self._rgb_buf.shape != shape:
+            self._rgb_buf = np.empty(shape, self.frame.dtype)
+
+        if CUDA_ENABLED:
+            # Resize and convert on the GPU, MediaPipe still needs the
+            # result in host memory
+            if self._gpu_rgb is None or self._gpu_rgb.size() != size:
+                self._gpu_resized = cv2.cuda_GpuMat(size[1], size[0], cv2.CV_8UC3)
+                self._gpu_rgb = cv2.cuda_GpuMat(size[1], size[0], cv2.CV_8UC3)
+
+            self._gpu_frame.upload(self.frame)
+            gpu_frame = self._gpu_frame
+            if scale < 1.0:
+                cv2.cuda.resize(gpu_frame, size, self._gpu_resized, interpolation=cv2.INTER_AREA)
+                gpu_frame = self._gpu_resized
+            cv2.cuda.cvtColor(gpu_frame, cv2.COLOR_BGR2RGB, self._gpu_rgb)
+            return self._gpu_rgb.download(self._rgb_buf)
+
+        if scale < 1.0:
+            cv2.resize(self.frame, size, dst=self._rgb_buf, interpolation=cv2.INTER_AREA)
+            return cv2.cvtColor(self._rgb_buf, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
+        return cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
 
     def _analyze(self):
         """Detects the face and initialize Eye objects"""
-        frame_rgb = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
-        results = self.face_mesh.process(frame_rgb)
-        
+        results = self.face_mesh.process(self._inference_frame())
+
         if not results.multi_face_landmarks:
             self.eye_left = None
             self.eye_right = None
+            self._locate_pupils()
             return False  # Indicate that no face was detected
 
         face_landmarks = results.multi_face_landmarks[0]
@@ -60,12 +202,30 @@ class GazeTracking(object):
         self.eye_left = Eye(self.frame, landmarks, 0, self.calibration)
         self.eye_right = Eye(self.frame, landmarks, 1, self.calibration)
 
-        if self.pupils_located:
-            gaze_point = self.horizontal_ratio(), self.vertical_ratio()
-            self.gaze_points.append(gaze_point)
+        self._locate_pupils()
+        if self._pupils_ok:
+            self._add_gaze_point(self._h_ratio, self._v_ratio)
 
         return True  # Indicate that a face was detected
 
+    def _add_gaze_point(self, x, y):
+        """Records a gaze point, overwriting the oldest one when full"""
+        i = self._gaze_index
+        self._gaze[0, i] = self._gaze[0, i + self._gaze_capacity] = x
+        self._gaze[1, i] = self._gaze[1, i + self._gaze_capacity] = y
+        self._gaze_index = (i + 1) % self._gaze_capacity
+        self._gaze_count = min(self._gaze_count + 1, self._gaze_capacity)
+
+    def _recent(self, k):
+        """Returns a (2, k) view on the k most recent gaze points, oldest
+        first, without copying them
+
+        Arguments:
+            k (int): Number of points, at most the number recorded
+        """
+        end = self._gaze_index + self._gaze_capacity
+        return self._gaze[:, end - k:end]
+
     def refresh(self, frame):
         """Refreshes the frame and analyzes it.
 
@@ -76,113 +236,114 @@ class GazeTracking(object):
             bool: True if a face was detected, False otherwise
         """
         self.frame = frame
+        self._frame_cache = {}
         return self._analyze()
 
     def pupil_left_coords(self):
         """Returns the coordinates of the left pupil"""
-        if self.pupils_located:
-            x = self.eye_left.origin[0] + self.eye_left.pupil.x
-            y = self.eye_left.origin[1] + self.eye_left.pupil.y
-            return (x, y)
+        return self._left_xy
 
     def pupil_right_coords(self):
         """Returns the coordinates of the right pupil"""
-        if self.pupils_located:
-            x = self.eye_right.origin[0] + self.eye_right.pupil.x
-            y = self.eye_right.origin[1] + self.eye_right.pupil.y
-            return (x, y)
+        return self._right_xy
 
     def horizontal_ratio(self):
         """Returns a number between 0.0 and 1.0 that indicates the
         horizontal direction of the gaze. The extreme right is 0.0,
         the center is 0.5 and the extreme left is 1.0
         """
-        if self.pupils_located:
-            pupil_left = self.eye_left.pupil.x / (self.eye_left.center[0] * 2 - 10)
-            pupil_right = self.eye_right.pupil.x / (self.eye_right.center[0] * 2 - 10)
-            return (pupil_left + pupil_right) / 2
+        return self._h_ratio
 
     def vertical_ratio(self):
         """Returns a number between 0.0 and 1.0 that indicates the
         vertical direction of the gaze. The extreme top is 0.0,
         the center is 0.5 and the extreme bottom is 1.0
         """
-        if self.pupils_located:
-            pupil_left = self.eye_left.pupil.y / (self.eye_left.center[1] * 2 - 10)
-            pupil_right = self.eye_right.pupil.y / (self.eye_right.center[1] * 2 - 10)
-            return (pupil_left + pupil_right) / 2
+        return self._v_ratio
 
     def is_right(self):
         """Returns true if the user is looking to the right"""
-        if self.pupils_located:
-            return self.horizontal_ratio() <= 0.35
+        if self._pupils_ok:
+            return self._h_ratio <= 0.35
 
     def is_left(self):
         """Returns true if the user is looking to the left"""
-        if self.pupils_located:
-            return self.horizontal_ratio() >= 0.65
+        if self._pupils_ok:
+            return self._h_ratio >= 0.65
 
     def is_center(self):
         """Returns true if the user is looking to the center"""
-        if self.pupils_located:
-            return self.is_right() is not True and self.is_left() is not True
+        if self._pupils_ok:
+            return 0.35 < self._h_ratio < 0.65
 
     def is_blinking(self):
         """Returns true if the user closes his eyes"""
-        if self.pupils_located:
-            blinking_ratio = (self.eye_left.blinking + self.eye_right.blinking) / 2
-            return blinking_ratio > 3.8
+        if self._pupils_ok and self._blink_ratio is not None:
+            return self._blink_ratio > 3.8
+
+    def state(self):
+        """Returns what the eyes are doing in one call: 'BLINK', 'RIGHT',
+        'LEFT', 'CENTER', or 'NONE' if the pupils are not located
+        """
+        if not self._pupils_ok:
+            return 'NONE'
+        if self._blink_ratio is not None and self._blink_ratio > 3.8:
+            return 'BLINK'
+        if self._h_ratio <= 0.35:
+            return 'RIGHT'
+        if self._h_ratio >= 0.65:
+            return 'LEFT'
+        return 'CENTER'
 
+    @_per_frame
     def detect_saccade(self):
         """Detects if a saccade occurred in the last frame"""
-        if len(self.gaze_points) < 2:
+        if self._gaze_count < 2:
             return False
-        
-        current_point = self.gaze_points[-1]
-        previous_point = self.gaze_points[-2]
-        
-        distance = np.sqrt((current_point[0] - previous_point[0])**2 + 
-                           (current_point[1] - previous_point[1])**2)
-        
-        return distance > self.saccade_threshold
 
+        # Plain Python floats, NumPy scalar arithmetic would cost more than
+        # the computation itself
+        current = self._gaze_index + self._gaze_capacity - 1
+        dx = self._gaze.item(0, current) - self._gaze.item(0, current - 1)
+        dy = self._gaze.item(1, current) - self._gaze.item(1, current - 1)
+
+        # Squared distances avoid the square root
+        return bool(dx * dx + dy * dy > self.saccade_threshold ** 2)
+
+    @_per_frame
     def detect_fixation(self):
         """Detects if the gaze is currently in a fixation"""
-        if len(self.gaze_points) < self.min_fixation_duration:
+        if self._gaze_count < self.min_fixation_duration:
             return False
-        
-        recent_points = list(self.gaze_points)[-self.min_fixation_duration:]
-        center = np.mean(recent_points, axis=0)
-        
-        for point in recent_points:
-            distance = np.sqrt((point[0] - center[0])**2 + (point[1] - center[1])**2)
-            if distance > self.fixation_threshold:
-                return False
-        
-        return True
+
+        recent = self._recent(self.min_fixation_duration)
+
+        # A single reduction over squared distances to the center, both
+        # coordinates at once
+        offsets = recent - recent.mean(axis=1, keepdims=True)
+        return bool((offsets * offsets).sum(axis=0).max() <= self.fixation_threshold ** 2)
 
     def get_fixation_center(self):
         """Returns the center of the current fixation"""
         if self.detect_fixation():
-            recent_points = list(self.gaze_points)[-self.min_fixation_duration:]
-            return np.mean(recent_points, axis=0)
+            return self._recent(self.min_fixation_duration).mean(axis=1)
         return None
 
     def annotated_frame(self):
         """Returns the main frame with pupils highlighted"""
         frame = self.frame.copy()
 
-        if self.pupils_located:
+        if self._pupils_ok:
             color = (0, 255, 0)
-            x_left, y_left = self.pupil_left_coords()
-            x_right, y_right = self.pupil_right_coords()
+            x_left, y_left = self._left_xy
+            x_right, y_right = self._right_xy
             cv2.line(frame, (x_left - 5, y_left), (x_left + 5, y_left), color)
             cv2.line(frame, (x_left, y_left - 5), (x_left, y_left + 5), color)
             cv2.line(frame, (x_right - 5, y_right), (x_right + 5, y_right), color)
             cv2.line(frame, (x_right, y_right - 5), (x_right, y_right + 5), color)
 
             h, w = frame.shape[:2]
-            gaze_ratio = self.horizontal_ratio(), self.vertical_ratio()
+            gaze_ratio = self._h_ratio, self._v_ratio
             x = int(gaze_ratio[0] * w)
             y = int(gaze_ratio[1] * h)
             
@@ -199,7 +360,3 @@ class GazeTracking(object):
             cv2.putText(frame, "No face detected", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
 
         return frame
-
-    def __del__(self):
-        """Clean up resources"""
-        self.face_mesh.close()
\ No newline at end of file
@@ -1,113 +1,211 @@
+import collections
 import cv2
 import logging
+import multiprocessing
 import os
+import queue
+import threading
 from gaze_tracking import GazeTracking
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-logging.debug('Starting the GazeTracking demo')
-
-gaze = GazeTracking()
-
-# Load the video file
-video_path = 'naz_test.mp4'
-logging.debug(f'Loading video from {video_path}')
-
-# Check if the video file exists
-if not os.path.exists(video_path):
-    logging.error(f'Video file does not exist: {video_path}')
-    exit()
-
-video = cv2.VideoCapture(video_path)
-
-if not video.isOpened():
-    logging.error(f'Error opening video file: {video_path}')
-    exit()
-
-# Get the video frame width, height, and frames per second (fps)
-frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-fps = video.get(cv2.CAP_PROP_FPS)
-logging.debug(f'Video properties - Width: {frame_width}, Height: {frame_height}, FPS: {fps}')
-
-# Read the first frame to determine the image format
-ret, first_frame = video.read()
-if not ret:
-    logging.error('Error reading the first frame of the video.')
-    exit()
-
-# Determine the format of the first frame
-if first_frame.shape[2] == 3:
-    image_format = 'RGB'
-    logging.debug('First frame is in RGB format.')
-else:
-    logging.debug('First frame is not in RGB format, converting it.')
-    first_frame = cv2.cvtColor(first_frame, cv2.COLOR_BGR2RGB)
-    image_format = 'Converted to RGB'
-
-# Reinitialize the video capture to start from the beginning
-video.release()
-video = cv2.VideoCapture(video_path)
-
-# Define the codec and create VideoWriter object
-output_path = 'naz_test_output.mp4'
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # For .mp4 files
-out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height))
-
-if not out.isOpened():
-    logging.error(f'Error opening video writer: {output_path}')
-    exit()
-
-frame_count = 0
-while True:
-    # We get a new frame from the video
-    ret, frame = video.read()
-
-    # If the frame was not read correctly, break the loop
-    if not ret:
-        logging.debug('No more frames to read or error reading frame.')
-        break
-
-    frame_count += 1
-    logging.debug(f'Processing frame {frame_count}')
-
-    # Convert the frame to RGB if it is not already
-    if image_format == 'Converted to RGB':
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-    # We send this frame to GazeTracking to analyze it
-    gaze.refresh(frame)
-
-    frame = gaze.annotated_frame()
-    text = ""
-
-    if gaze.is_blinking():
-        text = "Blinking"
-    elif gaze.is_right():
-        text = "Looking right"
-    elif gaze.is_left():
-        text = "Looking left"
-    elif gaze.is_center():
-        text = "Looking center"
-
-    cv2.putText(frame, text, (90, 60), cv2.FONT_HERSHEY_DUPLEX, 1.6, (147, 58, 31), 2)
-
-    left_pupil = gaze.pupil_left_coords()
-    right_pupil = gaze.pupil_right_coords()
-    cv2.putText(frame, "Left pupil:  " + str(left_pupil), (90, 130), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
-    cv2.putText(frame, "Right pupil: " + str(right_pupil), (90, 165), cv2.FONT_HERSHEY_DUPLEX, 0.9, (147, 58, 31), 1)
-
-    # Convert the frame back to BGR for saving if needed
-    if image_format == 'Converted to RGB':
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-    # Write the frame into the output video
-    out.write(frame)
-
-    logging.debug(f'Frame {frame_count} written to output video.')
-
-# Release everything if the job is finished
-video.release()
-out.release()
-logging.debug(f'Video processing completed. Output saved to {output_path}')
\ No newline at end of file
+# Cap OpenCV's internal thread pool
+cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
+# Number of consecutive frames analyzed by a worker in one go. Every frame
+# in flight is a full raw or annotated frame, so chunks are kept small.
+CHUNK_SIZE = 24
+
+# Frames of the previous chunk a worker analyzes again before a chunk,
+# without writing them out. They rebuild enough gaze history for fixation
+# (GazeTracking.min_fixation_duration points) and saccade detection from
+# the first frame written out. Each worker still calibrates on its own
+# frames, so the output can differ slightly from a serial run. The overlap
+# is shipped and run through FaceMesh again, CHUNK_OVERLAP / CHUNK_SIZE
+# (about 40%) more inference than a serial run.
+CHUNK_OVERLAP = 10
+
+# Style of the text drawn over the frames
+FONT = cv2.FONT_HERSHEY_DUPLEX
+COLOR = (147, 58, 31)
+
+# Text shown for each state returned by GazeTracking.state()
+LABELS = {
+    'BLINK': "Blinking",
+    'RIGHT': "Looking right",
+    'LEFT': "Looking left",
+    'CENTER': "Looking center",
+    'NONE': "",
+}
+
+# GazeTracking instance of a worker process
+gaze = None
+
+
+def init_worker():
+    # MediaPipe graphs are not fork-safe, each worker builds its own
+    global gaze
+    gaze = GazeTracking()
+
+
+def process_chunk(frames, overlap):
+    # Analyze consecutive frames and return them annotated, in order, except
+    # for the first `overlap` frames which only warm up the analysis
+    gaze.reset(keep_calibration=True)
+    annotated_frames = []
+    put_text = cv2.putText
+
+    for index, frame in enumerate(frames):
+        # We send this frame to GazeTracking to analyze it, in the BGR
+        # order VideoCapture decodes to
+        gaze.refresh(frame)
+        if index < overlap:
+            continue
+
+        frame = gaze.annotated_frame()
+        text = LABELS[gaze.state()]
+        put_text(frame, text, (90, 60), FONT, 1.6, COLOR, 2)
+
+        left_pupil = gaze.pupil_left_coords()
+        right_pupil = gaze.pupil_right_coords()
+        left_text = f"({left_pupil[0]}, {left_pupil[1]})" if left_pupil else "None"
+        right_text = f"({right_pupil[0]}, {right_pupil[1]})" if right_pupil else "None"
+        put_text(frame, "Left pupil:  " + left_text, (90, 130), FONT, 0.9, COLOR, 1)
+        put_text(frame, "Right pupil: " + right_text, (90, 165), FONT, 0.9, COLOR, 1)
+
+        annotated_frames.append(frame)
+
+    return annotated_frames
+
+
+def read_frames(video, frames):
+    # Decode the video ahead of the main loop, then send None
+    while True:
+        ret, frame = video.read()
+        if not ret:
+            break
+        frames.put(frame)
+    frames.put(None)
+
+
+def read_chunks(frames):
+    # Group the decoded frames into chunks of consecutive frames, each one
+    # starting with the last CHUNK_OVERLAP frames of the previous chunk
+    chunk = []
+    overlap = 0
+    while True:
+        frame = frames.get()
+
+        # If the frame was not read correctly, stop
+        if frame is None:
+            logging.debug('No more frames to read or error reading frame.')
+            break
+
+        chunk.append(frame)
+        if len(chunk) == overlap + CHUNK_SIZE:
+            yield chunk, overlap
+            chunk = chunk[-CHUNK_OVERLAP:]
+            overlap = len(chunk)
+
+    if len(chunk) > overlap:
+        yield chunk, overlap
+
+
+def queue_chunk(annotated_frames, frames, frame_count):
+    # Hand the frames of a chunk over to the writer thread, returns the
+    # number of frames handed over so far
+    for frame in annotated_frames:
+        frame_count += 1
+        if frame_count % 100 == 0:  # Log every 100 frames
+            logging.debug(f'Processing frame {frame_count}')
+
+        # annotated_frame() returns a new array every time, so it can be
+        # queued without a copy
+        frames.put(frame)
+    return frame_count
+
+
+def write_frames(out, frames):
+    # Encode the frames handed over by the main loop, until it sends None
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        out.write(frame)
+
+
+def main():
+    logging.debug('Starting the GazeTracking demo')
+
+    # Load the video file
+    video_path = 'naz_test.mp4'
+    logging.debug(f'Loading video from {video_path}')
+
+    # Check if the video file exists
+    if not os.path.exists(video_path):
+        logging.error(f'Video file does not exist: {video_path}')
+        exit()
+
+    video = cv2.VideoCapture(video_path)
+    video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    if not video.isOpened():
+        logging.error(f'Error opening video file: {video_path}')
+        exit()
+
+    # Get the video frame width, height, and frames per second (fps)
+    frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    logging.debug(f'Video properties - Width: {frame_width}, Height: {frame_height}, FPS: {fps}')
+
+    # Define the codec and create VideoWriter object
+    output_path = 'naz_test_output.mp4'
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # For .mp4 files
+    out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height))
+
+    if not out.isOpened():
+        logging.error(f'Error opening video writer: {output_path}')
+        exit()
+
+    # Decoding and encoding run in background threads, connected to the main
+    # loop by bounded queues, so the main loop doesn't wait on either
+    read_queue = queue.Queue(maxsize=8)
+    reader_thread = threading.Thread(target=read_frames, args=(video, read_queue), daemon=True)
+    reader_thread.start()
+
+    write_queue = queue.Queue(maxsize=8)
+    writer_thread = threading.Thread(target=write_frames, args=(out, write_queue), daemon=True)
+    writer_thread.start()
+
+    # Chunks of frames are analyzed in parallel and collected in the order
+    # they were submitted. One chunk per worker plus the next one are in
+    # flight, at most (nb_workers + 1) * (CHUNK_SIZE + CHUNK_OVERLAP) frames.
+    # Once that many are pending, the oldest is waited for before reading
+    # more, so results can't pile up when the writer thread falls behind.
+    context = multiprocessing.get_context('spawn')
+    nb_workers = os.cpu_count()
+    max_pending = nb_workers + 1
+    pending = collections.deque()
+    frame_count = 0
+    with context.Pool(nb_workers, initializer=init_worker) as pool:
+        for chunk in read_chunks(read_queue):
+            pending.append(pool.apply_async(process_chunk, chunk))
+            if len(pending) == max_pending:
+                frame_count = queue_chunk(pending.popleft().get(), write_queue, frame_count)
+
+        while pending:
+            frame_count = queue_chunk(pending.popleft().get(), write_queue, frame_count)
+
+    # Release everything if the job is finished
+    write_queue.put(None)
+    reader_thread.join()
+    writer_thread.join()
+    video.release()
+    out.release()
+    logging.debug(f'Video processing completed. Output saved to {output_path}')
+
+
+if __name__ == '__main__':
+    main()